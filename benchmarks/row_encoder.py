@@ -0,0 +1,80 @@
+"""
+Compares rows/sec of the compiled row encoder (Schema.encode) with the conversion insert_rows does for every batch.
+Usage:
+    python benchmarks/row_encoder.py [num_rows]
+"""
+import datetime
+import decimal
+import sys
+import time
+
+import pytz
+from google.cloud.bigquery._helpers import _record_field_to_json
+
+from pygbq.pygbq import Schema
+
+SCHEMA_LIST = [
+    {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "price", "type": "NUMERIC", "mode": "NULLABLE"},
+    {"name": "score", "type": "FLOAT", "mode": "NULLABLE"},
+    {"name": "active", "type": "BOOLEAN", "mode": "NULLABLE"},
+    {"name": "created_at", "type": "TIMESTAMP", "mode": "NULLABLE"},
+    {"name": "day", "type": "DATE", "mode": "NULLABLE"},
+    {"name": "tags", "type": "STRING", "mode": "REPEATED"},
+    {
+        "name": "items",
+        "type": "RECORD",
+        "mode": "REPEATED",
+        "fields": [
+            {"name": "sku", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "quantity", "type": "INTEGER", "mode": "NULLABLE"},
+            {"name": "updated_at", "type": "DATETIME", "mode": "NULLABLE"},
+        ],
+    },
+]
+
+
+def make_rows(num_rows):
+    created_at = datetime.datetime(2021, 1, 1, 12, 30, tzinfo=pytz.utc)
+    return [
+        {
+            "id": i,
+            "name": f"name_{i}",
+            "price": decimal.Decimal("9.99"),
+            "score": i / 3,
+            "active": i % 2 == 0,
+            "created_at": created_at,
+            "day": created_at.date(),
+            "tags": ["a", "b"],
+            "items": [
+                {"sku": "sku_1", "quantity": 1, "updated_at": created_at.replace(tzinfo=None)},
+                {"sku": "sku_2", "quantity": None, "updated_at": None},
+            ],
+        }
+        for i in range(num_rows)
+    ]
+
+
+def rows_per_second(encode, rows, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(rows)
+        best = min(best, time.perf_counter() - start)
+    return len(rows) / best
+
+
+def main(num_rows=100000):
+    schema = Schema(schema_list=SCHEMA_LIST)
+    rows = make_rows(num_rows)
+    assert schema.encode(rows) == [_record_field_to_json(schema.schema_api, row) for row in rows]
+
+    current = rows_per_second(lambda batch: [_record_field_to_json(schema.schema_api, row) for row in batch], rows)
+    compiled = rows_per_second(schema.encode, rows)
+    print(f"insert_rows conversion: {current:,.0f} rows/sec")
+    print(f"compiled row encoder:   {compiled:,.0f} rows/sec ({compiled / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
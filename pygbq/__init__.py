@@ -1,5 +1,6 @@
 from .pygbq import (
     Client,
+    Pipeline,
     read_jsonl,
     PyGBQError,
     PyGBQNameError,
@@ -14,6 +14,10 @@ from pathlib import Path
 import random
 from bigquery_schema_generator.generate_schema import SchemaGenerator
 import time
+import base64
+import decimal
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from typing import List, Union, Any, Callable, OrderedDict  # Optional, Dict
 
@@ -124,6 +128,177 @@ def _id_generator(size=10, chars=string.ascii_uppercase + string.digits):
     return "".join(random.choice(chars) for _ in range(size))
 
 
+def _to_date(value, field_type):
+    """Date of a DATE/DATETIME/TIMESTAMP value as it is stored, or None if it can't be told without guessing"""
+    if isinstance(value, datetime.datetime):
+        # only TIMESTAMP is stored in UTC, DATETIME and DATE keep the wall time of an aware datetime
+        if value.tzinfo is not None and field_type == "TIMESTAMP":
+            value = value.astimezone(pytz.utc)
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.strptime(value[:10], "%Y-%m-%d").date()
+        except ValueError:
+            return None
+    return None
+
+
+def _pruning_bounds(field_type, values):
+    """
+    Returns SQL literals (low, high) such that every value lies in [low, high], or None if the type is not supported.
+    Temporal values are widened to whole days: a TIMESTAMP string may carry any UTC offset, so its date is only known
+    up to a day in each direction.
+    """
+    if field_type in {"DATE", "DATETIME", "TIMESTAMP"}:
+        dates = [_to_date(value, field_type) for value in values]
+        if None in dates:
+            return None
+        low, high = min(dates), max(dates)
+        if field_type == "DATETIME":
+            high += datetime.timedelta(days=1)
+        elif field_type == "TIMESTAMP":
+            low -= datetime.timedelta(days=1)
+            high += datetime.timedelta(days=2)
+        return f"{field_type} '{low.isoformat()}'", f"{field_type} '{high.isoformat()}'"
+    if field_type in {"INTEGER", "INT64"}:
+        try:
+            integers = [int(value) for value in values]
+        except (TypeError, ValueError):
+            return None
+        return str(min(integers)), str(max(integers))
+    if field_type == "STRING":
+        strings = [str(value) for value in values]
+        return json.dumps(min(strings), ensure_ascii=False), json.dumps(max(strings), ensure_ascii=False)
+    return None
+
+
+# Row encoding mirrors google.cloud.bigquery._helpers._record_field_to_json (what insert_rows does for every row),
+# but the type dispatch is done once per schema instead of once per value.
+def _int_to_json(value):
+    return str(value) if isinstance(value, int) else value
+
+
+def _float_to_json(value):
+    # google-cloud-bigquery 2.6.1 sends FLOAT values as they are, which fails on Decimal (not JSON serializable)
+    return float(value) if isinstance(value, decimal.Decimal) else value
+
+
+def _decimal_to_json(value):
+    return str(value) if isinstance(value, decimal.Decimal) else value
+
+
+def _bool_to_json(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+def _bytes_to_json(value):
+    return base64.standard_b64encode(value).decode("ascii") if isinstance(value, bytes) else value
+
+
+def _timestamp_to_json(value):
+    if isinstance(value, datetime.datetime):
+        # naive datetimes are assumed to be in UTC
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return value
+
+
+def _datetime_to_json(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%f") if isinstance(value, datetime.datetime) else value
+
+
+def _date_to_json(value):
+    return value.isoformat() if isinstance(value, datetime.date) else value
+
+
+def _time_to_json(value):
+    return value.isoformat() if isinstance(value, datetime.time) else value
+
+
+_SCALAR_TO_JSON = {
+    "INTEGER": _int_to_json,
+    "INT64": _int_to_json,
+    "FLOAT": _float_to_json,
+    "FLOAT64": _float_to_json,
+    "NUMERIC": _decimal_to_json,
+    "BIGNUMERIC": _decimal_to_json,
+    "BOOLEAN": _bool_to_json,
+    "BOOL": _bool_to_json,
+    "BYTES": _bytes_to_json,
+    "TIMESTAMP": _timestamp_to_json,
+    "DATETIME": _datetime_to_json,
+    "DATE": _date_to_json,
+    "TIME": _time_to_json,
+}
+
+
+def _field_encoder(field):
+    """Returns a function converting a value of the field, None if the value is JSON-ready as is (e.g. STRING)"""
+    if field["type"] in {"RECORD", "STRUCT"}:
+        encode = _record_encoder(field["fields"])
+    else:
+        encode = _SCALAR_TO_JSON.get(field["type"])
+    if field.get("mode") != "REPEATED":
+        return encode
+    if encode is None:
+        return list
+    return lambda values: [None if value is None else encode(value) for value in values]
+
+
+def _record_encoder(fields):
+    field_names = tuple(field["name"] for field in fields)
+    names = frozenset(field_names)
+    encoders = [(field["name"], _field_encoder(field)) for field in fields]
+    plain_names = tuple(name for name, encode in encoders if encode is None)
+    encoders = tuple((name, encode) for name, encode in encoders if encode is not None)
+
+    def encode_record(row):
+        if not isinstance(row, dict):
+            # like insert_rows, a tuple/list row holds a value for every field in the schema order
+            if len(row) != len(field_names):
+                raise PyGBQError(
+                    f"The number of row fields ({len(row)}) does not match schema length ({len(field_names)})"
+                )
+            row = dict(zip(field_names, row))
+        record = {}
+        for name in plain_names:
+            value = row.get(name)
+            if value is not None:
+                record[name] = value
+        for name, encode in encoders:
+            value = row.get(name)
+            if value is not None:
+                record[name] = encode(value)
+        # like insert_rows, keys that are not in the schema are sent as strings
+        if not names.issuperset(row):
+            for name in row.keys() - names:
+                value = row[name]
+                if value is not None:
+                    record[name] = str(value)
+        return record
+
+    return encode_record
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_row_encoder(schema_key: str):
+    return _record_encoder(json.loads(schema_key))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_schema_api(schema_key: str):
+    return tuple(Schema._gen_schema_api(json.loads(schema_key)))
+
+
+def _schema_key(schema_list):
+    return json.dumps(schema_list, sort_keys=True)
+
+
 class Schema:
     def __init__(self, data=None, schema_list: List[Union[dict, OrderedDict]] = None, schema_api=None, schema_path=None):
         """probably should be set only one of arguments"""
@@ -143,6 +318,21 @@ class Schema:
         else:
             self.schema_list = []
             self.schema_api = []
+        self._row_encoder = None
+
+    @property
+    def row_encoder(self):
+        """Function converting a dict row to a JSON-ready dict, compiled once per schema and shared between Schemas"""
+        if self._row_encoder is None:
+            self._row_encoder = _compile_row_encoder(_schema_key(self.schema_list))
+        return self._row_encoder
+
+    def encode(self, rows):
+        """Converts dict rows to what insert_rows_json expects"""
+        if not self.schema_list:
+            # like insert_rows, without a schema every value would be sent as a string
+            raise PyGBQError("Could not determine schema, can't convert rows")
+        return list(map(self.row_encoder, rows))
 
     @staticmethod
     def gen_schema_list(schema_api):
@@ -150,6 +340,10 @@ class Schema:
 
     @staticmethod
     def gen_schema_api(schema_list):
+        return list(_compile_schema_api(_schema_key(schema_list)))
+
+    @staticmethod
+    def _gen_schema_api(schema_list):
         schema_api = []
         for field in schema_list:
             if field["type"] != "RECORD":
@@ -164,7 +358,7 @@ class Schema:
                         field["name"],
                         field["type"],
                         mode=field["mode"],
-                        fields=tuple(Schema.gen_schema_api(field["fields"])),
+                        fields=tuple(Schema._gen_schema_api(field["fields"])),
                     )
                 )
         return schema_api
@@ -185,16 +379,67 @@ class Update:
         Used as a helper class to store schema, how,  in update_table_using_temp
     """
 
-    def __init__(self, client, how=None, table_id=None, schema=Schema(), expiration=None):
+    def __init__(self, client, how=None, table_id=None, schema=Schema(), expiration=None, estimate_pruning=False):
         self.client = client
         self.how = how
         self.table_id = table_id
         self.schema = schema
+        self.partition_field = None
+        self.clustering_fields = []
         if isinstance(how, list):
+            self.read_partitioning()
             self.query_template = self.prepare_query()
         self.expiration = expiration
+        self.estimate_pruning = estimate_pruning
         self.errors = []
 
+    def read_partitioning(self):
+        """Reads partitioning and clustering spec of the target table"""
+        table = self.client.get_table(self.table_id)
+        if table.time_partitioning is not None:
+            # field is None for ingestion-time partitioning, there is no column to prune on
+            self.partition_field = table.time_partitioning.field
+        elif table.range_partitioning is not None:
+            self.partition_field = table.range_partitioning.field
+        self.clustering_fields = list(table.clustering_fields or [])
+
+    def pruning_condition(self, data_batch):
+        """
+        Returns a predicate restricting T to the partition/cluster values present in data_batch, e.g.
+            " AND T.date BETWEEN DATE '2021-01-01' AND DATE '2021-01-02'"
+        Only columns in `how` are used: since T.column = S.column, the matched rows can't fall outside the range.
+        """
+        field_types = {field["name"]: field["type"] for field in self.schema.schema_list}
+        field_names = [field["name"] for field in self.schema.schema_list]
+        # like insert_rows, a tuple/list row holds a value for every field in the schema order
+        rows = [row if isinstance(row, dict) else dict(zip(field_names, row)) for row in data_batch]
+        fields = [self.partition_field] + [field for field in self.clustering_fields if field != self.partition_field]
+        conditions = []
+        for field in fields:
+            if field not in self.how:
+                continue
+            # NULL never matches in the ON clause, so NULLs don't need to be covered
+            values = [row[field] for row in rows if row.get(field) is not None]
+            if not values:
+                continue
+            bounds = _pruning_bounds(field_types.get(field), values)
+            if bounds is None:
+                logging.warning(f"Can't prune on `{field}` of {self.table_id}, values are not comparable")
+                continue
+            conditions.append(f"T.{field} BETWEEN {bounds[0]} AND {bounds[1]}")
+        return "".join(f" AND {condition}" for condition in conditions)
+
+    def merge_query(self, table_tmp_id, pruning=""):
+        """:param pruning: predicate returned by pruning_condition"""
+        return self.query_template.format(table_id=self.table_id, table_tmp_id=table_tmp_id, pruning=pruning)
+
+    def estimate_bytes_saved(self, table_tmp_id, pruning):
+        """Dry-runs the merge with and without the pruning predicate and returns the difference in bytes processed"""
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        full = self.client.query(self.merge_query(table_tmp_id), job_config=job_config)
+        pruned = self.client.query(self.merge_query(table_tmp_id, pruning), job_config=job_config)
+        return full.total_bytes_processed - pruned.total_bytes_processed
+
     def merge(self, data_batch):
         # TODO: read https://cloud.google.com/bigquery/streaming-data-into-bigquery#template-tables
         tmp_id = _id_generator()
@@ -210,11 +455,22 @@ class Update:
         print(f"Updated expiration date of table {table_tmp_id}")
 
         print(f"Going to insert {len(data_batch)} rows to {table.table_id}")
-        self.errors = self.client.insert_rows(table, data_batch)
+        self.errors = self.client.insert_rows_json(table, self.schema.encode(data_batch))
         self.handle_errors(data_batch)
 
+        pruning = self.pruning_condition(data_batch)
+        # opt-in: two extra query jobs per batch
+        if self.estimate_pruning and pruning:
+            try:
+                bytes_saved = self.estimate_bytes_saved(table_tmp_id, pruning)
+            except Exception:
+                # e.g. no permission or require_partition_filter rejecting the unpruned dry run, the merge still works
+                logging.exception(f"Could not estimate bytes saved by partition pruning on {self.table_id}")
+            else:
+                print(f"Partition pruning saves an estimated {bytes_saved} bytes on {self.table_id}")
+
         # insert without duplicates
-        query = self.query_template.format(table_id=self.table_id, table_tmp_id=table_tmp_id)
+        query = self.merge_query(table_tmp_id, pruning)
         query_job = self.client.query(query)
         try:
             query_job.result()  # Waits for job to complete.
@@ -244,21 +500,26 @@ JOIN (SELECT {backtick_fields}, COUNT(*)
             self.client.delete_table(table=self.table_id)  # doesn't work without delete
         table = bigquery.Table(self.table_id, schema=self.schema.schema_api)
         table = self.client.create_table(table=table, exists_ok=True)
-        self.errors = self.client.insert_rows(table, data_batch)
+        self.errors = self.client.insert_rows_json(table, self.schema.encode(data_batch))
         self.handle_errors(data_batch)
 
     def insert(self, data_batch):
         table = self.client.get_table(self.table_id)
-        self.errors = self.client.insert_rows(table, data_batch)
+        if not self.schema.schema_list:
+            if not table.schema:
+                raise PyGBQError(f"Table {self.table_id} has no schema")
+            # read once, the same Update inserts all batches
+            self.schema = Schema(schema_api=table.schema)
+        self.errors = self.client.insert_rows_json(table, self.schema.encode(data_batch))
         self.handle_errors(data_batch)
 
     def prepare_query(self):
         """
-        Prepares query template.
+        Prepares query template. {pruning} is filled in per batch by pruning_condition.
         Example:
             MERGE `{table_id}` T
             USING `{table_tmp_id}` S
-                ON T.phase = S.phase AND T.phase_emoji = S.phase_emoji
+                ON T.phase = S.phase AND T.phase_emoji = S.phase_emoji{pruning}
             WHEN NOT MATCHED THEN
               INSERT ROW
             WHEN MATCHED THEN
@@ -274,7 +535,7 @@ JOIN (SELECT {backtick_fields}, COUNT(*)
     USING `{table_tmp_id}` S
         ON """
                 + condition
-                + """
+                + """{pruning}
     WHEN NOT MATCHED THEN
       INSERT ROW
     WHEN MATCHED THEN
@@ -326,7 +587,7 @@ class Client:
     # TODO: move all table_id, how, schema logic here to be able to call this function separately
     def update_table_using_temp(
             self, data, table_id, how, schema: Union[str, List[dict]] = None,
-            expiration=1, max_insert_num_rows=4000
+            expiration=1, max_insert_num_rows=4000, estimate_pruning=False
     ):
         """
         Creates a temp table, inserts rows there, then merges the table with the main table.
@@ -337,6 +598,7 @@ class Client:
         :param schema: path to the schema of temp table or the schema itself or None (then generate schema)
         :param expiration: how many hours temporary tables live before expiration
         :param max_insert_num_rows: we will split data into batches of this size
+        :param estimate_pruning: print bytes saved by partition pruning of every merge (two extra dry runs per batch)
         """
 
         def set_schema():
@@ -370,7 +632,7 @@ class Client:
         # save old table as table_name_old_schema_index, where index comes from try except
         # recreate table with broader schema and then insert
         if isinstance(how, list):
-            update = Update(self.client, how, table_id, schema, expiration)
+            update = Update(self.client, how, table_id, schema, expiration, estimate_pruning)
             for data_batch in data_batches:
                 update.merge(data_batch)
         elif how == 'insert':
@@ -407,9 +669,10 @@ class Client:
             return table_id
         raise PyGBQNameError("Bad table name")
 
-    def test(self, test):
+    def test(self, test, arguments: dict = None):
+        """:param arguments: values of the {placeholders} in test"""
         try:
-            result = self.client.query(test.format()).result()
+            result = self.client.query(test.format(**(arguments or {}))).result()
         except Exception as E:
             message = f"Bad test query: {test}"
             logging.exception(message)
@@ -434,8 +697,9 @@ class Client:
                 logging.exception(message)
         return message
 
-    def query(self, query):
-        query_job = self.client.query(query.format())
+    def query(self, query, arguments: dict = None):
+        """:param arguments: values of the {placeholders} in query"""
+        query_job = self.client.query(query.format(**(arguments or {})))
         try:
             query_job.result()
             message = 'Query executed correctly'
@@ -480,53 +744,137 @@ class Client:
         response = self.secretmanager_client.add_secret_version(parent=parent, payload=payload)
         print("Added secret version: {}".format(response.name))
 
-    # @parametrized
-    # def gbq(
-    #         self,
-    #         function: Callable[[Any], List[dict]],  # any arguments and returns a list of dicts
-    #         table: str = None,
-    #         how: Union[str, List[str]] = None,
-    #         schema: Union[str, List[dict]] = None,
-    #         query: str = None,
-    #         test: str = None
-    # ):
-    #     if not table:
-    #         table = function.__name__
-    #         print(table)
-    #     table_id = self._set_table_id(table)
-    #
-    #     def inner(**kwargs):
-    #         nonlocal how, schema
-    #         data = function(**kwargs)
-    #         results = {"data_len": len(data), **kwargs}
-    #         if isinstance(data, DataFrame):
-    #             if self.save_dir:
-    #                 name = self.file_name_for_save(table_id, kwargs, "csv")
-    #                 data.to_csv(name, index=False)
-    #             if how == "insert":
-    #                 how = "append"  # rename to to_gbq syntax
-    #             if data:
-    #                 data.to_gbq(table_id, project_id=self.project_id, if_exists=how, table_schema=schema)
-    #             else:
-    #                 logging.warning('Data is empty')
-    #                 results["message"] = "data is empty"
-    #         elif isinstance(data, list):
-    #             if self.save_dir:
-    #                 name = self.file_name_for_save(table_id, kwargs, "jsonl")
-    #                 save_data(data=data, name=name)
-    #             if how:
-    #                 if data:
-    #                     self.update_table_using_temp(data, table_id, how, schema)
-    #                     results["message"] = "success"
-    #                 else:
-    #                     logging.warning('Data is empty')
-    #                     results["message"] = "data is empty"
-    #         else:
-    #             raise PyGBQError(f"Returned {type(data)}. Need either list or df.")
-    #         if test:
-    #             self.test(test=test, arguments=kwargs)
-    #         if query:
-    #             self.query(query, kwargs)
-    #         return results
-    #
-    #     return inner
+
+class Pipeline:
+    """Runs extract -> load -> test -> query chains of many tables concurrently.
+    Usage:
+        pipeline = Pipeline(client, max_workers=8)
+
+        @pipeline.gbq(table='mydataset.mytable', how=['id'], test='SELECT ...')
+        def mytable():
+            return [{...}, {...}]
+
+        report = pipeline.run()
+    Functions are extracted in a pool of max_workers threads. Every table has its own queue that loads the data
+    as soon as an extraction finishes, so loads of one table never overlap and its test and query only wait
+    for its own load.
+    """
+
+    def __init__(self, client: Client, max_workers: int = 8):
+        self.client = client
+        self.max_workers = max_workers
+        self.tasks = []
+
+    def gbq(
+            self,
+            table: str = None,
+            how: Union[str, List[str]] = None,
+            schema: Union[str, List[dict]] = None,
+            query: str = None,
+            test: str = None
+    ):
+        """
+        Registers a function returning a list of dicts.
+        :param table: table_id as in update_table_using_temp, the function name if not set
+        :param how: as in update_table_using_temp, data is not loaded if not set
+        :param schema: as in update_table_using_temp
+        :param query: query to run after the load if the test passed, may contain {placeholders} of run kwargs
+        :param test: query returning exactly one boolean value to run after the load, may contain {placeholders}
+        """
+
+        def register(function: Callable[[Any], List[dict]]):
+            table_id = self.client._set_table_id(table or function.__name__)
+            self.tasks.append(
+                {"function": function, "table_id": table_id, "how": how, "schema": schema, "query": query, "test": test}
+            )
+            return function
+
+        return register
+
+    def run(self, **kwargs):
+        """
+        Runs all registered functions with kwargs, kwargs also fill the {placeholders} of test and query.
+        Returns a report per task (in registration order) with the timings of every step in seconds, e.g.
+            {"task": "mytable", "table_id": "myproject.mydataset.mytable", "data_len": 2, "extract_seconds": 0.5,
+             "load_seconds": 3.1, "test": True, "test_seconds": 1.2, "message": "success"}
+        """
+        reports = [{"task": task["function"].__name__, "table_id": task["table_id"]} for task in self.tasks]
+        table_queues = {task["table_id"]: ThreadPoolExecutor(max_workers=1) for task in self.tasks}
+        loads = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as extract_pool:
+                extractions = {
+                    extract_pool.submit(self._extract, task, report, kwargs): (task, report)
+                    for task, report in zip(self.tasks, reports)
+                }
+                for extraction in as_completed(extractions):
+                    task, report = extractions[extraction]
+                    data = extraction.result()
+                    if data is not None:
+                        loads.append(table_queues[task["table_id"]].submit(self._load, task, report, data, kwargs))
+            for load in loads:
+                load.result()
+        finally:
+            for table_queue in table_queues.values():
+                table_queue.shutdown()
+        return reports
+
+    @staticmethod
+    def _extract(task, report, kwargs):
+        start = time.perf_counter()
+        try:
+            data = task["function"](**kwargs)
+            if not isinstance(data, list):
+                raise PyGBQError(f"Returned `{type(data)}`. Need `list`.")
+        except Exception:
+            logging.exception(f"Extraction of {report['task']} failed")
+            report["message"] = "extract failed"
+            return None
+        finally:
+            report["extract_seconds"] = time.perf_counter() - start
+        report["data_len"] = len(data)
+        return data
+
+    def _load(self, task, report, data, kwargs):
+        if task["how"]:
+            if data:
+                start = time.perf_counter()
+                try:
+                    self.client.update_table_using_temp(data, task["table_id"], task["how"], task["schema"])
+                except Exception:
+                    logging.exception(f"Load of {report['task']} to {task['table_id']} failed")
+                    report["message"] = "load failed"
+                    return
+                finally:
+                    report["load_seconds"] = time.perf_counter() - start
+            else:
+                logging.warning('Data is empty')
+                report["message"] = "data is empty"
+        # a failed test skips the query
+        if task["test"]:
+            start = time.perf_counter()
+            try:
+                report["test"] = self.client.test(test=task["test"], arguments=kwargs)
+            except Exception:
+                logging.exception(f"Test of {report['task']} failed")
+                report["message"] = "test failed"
+                return
+            finally:
+                report["test_seconds"] = time.perf_counter() - start
+            if report["test"] is not True:
+                report["message"] = "test failed"
+                return
+        if task["query"]:
+            start = time.perf_counter()
+            try:
+                report["query"] = self.client.query(task["query"], arguments=kwargs)
+            except Exception:
+                logging.exception(f"Query of {report['task']} failed")
+                report["message"] = "query failed"
+                return
+            finally:
+                report["query_seconds"] = time.perf_counter() - start
+            if report["query"] != 'Query executed correctly':
+                report["message"] = "query failed"
+                return
+        report.setdefault("message", "success")
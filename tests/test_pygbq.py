@@ -1,5 +1,10 @@
 import pygbq
 import pytest
+import datetime
+import decimal
+import threading
+import time
+from google.cloud import bigquery
 
 client = pygbq.Client()
 
@@ -37,14 +42,215 @@ def test_merge():
     assert results == {"status": 200}
 
 
-# def test_gbq():
-#
-#     @client.gbq(table='test_dataset.test_table', how=['id'])
-#     def test_table():
-#         data = [{'id': 5, 'string_column': 'test_gbq_5'}, {'id': 6, 'string_column': 'test_gbq_6'}]
-#         return data
-#
-#     assert test_table() == {'status': 'success', 'data_len': 2}
+class StubBigQueryClient:
+    """Returns `table` on get_table so that the MERGE can be built without hitting BigQuery"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get_table(self, table_id):
+        return self.table
+
+
+def partitioned_update(how, date_type='DATE'):
+    table = bigquery.Table('pygbq-123456.test_dataset.test_table')
+    table.time_partitioning = bigquery.TimePartitioning(field='date')
+    table.clustering_fields = ['id']
+    schema = pygbq.pygbq.Schema(schema_list=[{'name': 'id', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+                                             {'name': 'date', 'type': date_type, 'mode': 'NULLABLE'}])
+    return pygbq.pygbq.Update(StubBigQueryClient(table), how, table.table_id, schema, expiration=1)
+
+
+def test_merge_query_pruning():
+    update = partitioned_update(how=['id', 'date'])
+    data = [{'id': 3, 'date': '2021-01-02'}, {'id': 1, 'date': '2021-01-01'}, {'id': 2, 'date': None}]
+    query = update.merge_query('test_table_tmp', update.pruning_condition(data))
+    assert "ON T.id = S.id AND T.date = S.date AND T.date BETWEEN DATE '2021-01-01' AND DATE '2021-01-02'" \
+           " AND T.id BETWEEN 1 AND 3\n" in query
+
+
+def test_merge_query_no_pruning_outside_how():
+    update = partitioned_update(how=['id'])
+    data = [{'id': 1, 'date': '2021-01-01'}]
+    query = update.merge_query('test_table_tmp', update.pruning_condition(data))
+    assert "ON T.id = S.id AND T.id BETWEEN 1 AND 1\n" in query
+    assert "T.date BETWEEN" not in query
+
+
+def test_merge_query_pruning_tuples():
+    update = partitioned_update(how=['id', 'date'])
+    data = [(1, '2021-01-01'), [2, '2021-01-03']]
+    query = update.merge_query('test_table_tmp', update.pruning_condition(data))
+    assert "T.date BETWEEN DATE '2021-01-01' AND DATE '2021-01-03' AND T.id BETWEEN 1 AND 2\n" in query
+
+
+def test_merge_query_pruning_aware_datetime():
+    # DATETIME keeps the wall time, 2021-01-02T01:00+05:00 is stored as 2021-01-02T01:00
+    update = partitioned_update(how=['id', 'date'], date_type='DATETIME')
+    plus_five = datetime.timezone(datetime.timedelta(hours=5))
+    data = [{'id': 1, 'date': datetime.datetime(2021, 1, 2, 1, 0, tzinfo=plus_five)}]
+    query = update.merge_query('test_table_tmp', update.pruning_condition(data))
+    assert "T.date BETWEEN DATETIME '2021-01-02' AND DATETIME '2021-01-03'" in query
+
+
+def test_merge_query_pruning_timestamp():
+    # a TIMESTAMP string may carry any offset, so the range is widened by a day on each side
+    update = partitioned_update(how=['id', 'date'], date_type='TIMESTAMP')
+    plus_five = datetime.timezone(datetime.timedelta(hours=5))
+    data = [{'id': 1, 'date': '2021-01-02 01:00:00+05:00'},
+            {'id': 2, 'date': datetime.datetime(2021, 1, 5, 1, 0, tzinfo=plus_five)}]
+    query = update.merge_query('test_table_tmp', update.pruning_condition(data))
+    assert "T.date BETWEEN TIMESTAMP '2021-01-01' AND TIMESTAMP '2021-01-06'" in query
+
+
+def test_schema_encode():
+    schema = pygbq.pygbq.Schema(schema_list=[
+        {'name': 'id', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+        {'name': 'price', 'type': 'NUMERIC', 'mode': 'NULLABLE'},
+        {'name': 'created_at', 'type': 'TIMESTAMP', 'mode': 'NULLABLE'},
+        {'name': 'items', 'type': 'RECORD', 'mode': 'REPEATED', 'fields': [
+            {'name': 'day', 'type': 'DATE', 'mode': 'NULLABLE'},
+            {'name': 'active', 'type': 'BOOLEAN', 'mode': 'NULLABLE'}]}])
+    created_at = datetime.datetime(2021, 1, 1, 13, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+    data = [{'id': 1, 'price': decimal.Decimal('9.99'), 'created_at': created_at, 'unknown': 2,
+             'items': [{'day': datetime.date(2021, 1, 2), 'active': True}, {'day': None}]},
+            {'id': 2, 'price': None}]
+    assert schema.encode(data) == [
+        {'id': '1', 'price': '9.99', 'created_at': '2021-01-01T12:30:00.000000Z', 'unknown': '2',
+         'items': [{'day': '2021-01-02', 'active': 'true'}, {}]},
+        {'id': '2'}]
+    assert pygbq.pygbq.Schema(schema_list=schema.schema_list).row_encoder is schema.row_encoder
+
+
+def test_schema_encode_tuples():
+    schema = pygbq.pygbq.Schema(schema_list=[
+        {'name': 'id', 'type': 'INTEGER', 'mode': 'NULLABLE'},
+        {'name': 'item', 'type': 'RECORD', 'mode': 'NULLABLE', 'fields': [
+            {'name': 'sku', 'type': 'STRING', 'mode': 'NULLABLE'},
+            {'name': 'score', 'type': 'FLOAT', 'mode': 'NULLABLE'}]}])
+    assert schema.encode([(1, ('sku_1', decimal.Decimal('0.5'))), [2, None]]) == [
+        {'id': '1', 'item': {'sku': 'sku_1', 'score': 0.5}}, {'id': '2'}]
+    with pytest.raises(pygbq.PyGBQError):
+        schema.encode([(1,)])
+    with pytest.raises(pygbq.PyGBQError):
+        pygbq.pygbq.Schema().encode([{'a': 1}])
+
+
+class StubClient(pygbq.Client):
+    """Records loads, tests and queries instead of running them on BigQuery"""
+
+    def __init__(self, load_seconds=None):
+        self.project_id = 'pygbq-123456'
+        self.default_dataset = 'test_dataset'
+        self.load_seconds = load_seconds or {}
+        self.lock = threading.Lock()
+        self.events = []
+        self.loading = set()
+
+    def record(self, *event):
+        with self.lock:
+            self.events.append(event)
+
+    def update_table_using_temp(self, data, table_id, how, schema=None, **kwargs):
+        if data[0].get('fail'):
+            raise pygbq.PyGBQError('load failed')
+        with self.lock:
+            assert table_id not in self.loading, 'loads of one table must not overlap'
+            self.loading.add(table_id)
+        self.record('load start', table_id, data[0]['id'])
+        time.sleep(self.load_seconds.get(table_id, 0))
+        self.record('load end', table_id, data[0]['id'])
+        with self.lock:
+            self.loading.remove(table_id)
+
+    def test(self, test, arguments=None):
+        test = test.format(**(arguments or {}))
+        self.record('test', test)
+        return True if test == 'SELECT 1=1' else f"'{test}' did not pass"
+
+    def query(self, query, arguments=None):
+        query = query.format(**(arguments or {}))
+        self.record('query', query)
+        return f"Your query '{query}' is incorrect" if query == 'SELECT' else 'Query executed correctly'
+
+
+def register(pipeline, name, data, extract_seconds=0, **kwargs):
+    def function(**kwargs):
+        time.sleep(extract_seconds)
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    function.__name__ = name
+    pipeline.gbq(**kwargs)(function)
+
+
+def test_pipeline_per_table_loads():
+    stub = StubClient(load_seconds={'pygbq-123456.test_dataset.slow': 0.3})
+    pipeline = pygbq.Pipeline(stub, max_workers=4)
+    # extractions finish in the order 2, 1, 3 and are loaded into `slow` in that order, one at a time
+    register(pipeline, 'slow_1', [{'id': 1}], 0.1, table='slow', how=['id'], test='SELECT 1=1')
+    register(pipeline, 'slow_2', [{'id': 2}], 0.0, table='slow', how=['id'], test='SELECT 1=1')
+    register(pipeline, 'slow_3', [{'id': 3}], 0.2, table='slow', how=['id'], test='SELECT 1=1')
+    register(pipeline, 'fast', [{'id': 4}], 0.0, table='fast', how=['id'], test='SELECT 1=1', query='SELECT 1')
+
+    reports = pipeline.run()
+    assert [report['task'] for report in reports] == ['slow_1', 'slow_2', 'slow_3', 'fast']
+    assert all(report['message'] == 'success' for report in reports)
+    assert all('extract_seconds' in report and 'load_seconds' in report for report in reports)
+    slow_loads = [event[2] for event in stub.events if event[:2] == ('load start', 'pygbq-123456.test_dataset.slow')]
+    assert slow_loads == [2, 1, 3]
+    # the test and query of `fast` don't wait for the loads of `slow`
+    assert stub.events.index(('query', 'SELECT 1')) < stub.events.index(('load end', 'pygbq-123456.test_dataset.slow', 2))
+
+
+def test_pipeline_failures():
+    stub = StubClient()
+    pipeline = pygbq.Pipeline(stub, max_workers=2)
+    register(pipeline, 'extract_raises', ValueError('bad source'), table='table_1', how=['id'])
+    register(pipeline, 'returns_none', None, table='table_2', how=['id'])
+    register(pipeline, 'load_fails', [{'id': 1, 'fail': True}], table='table_3', how=['id'], test='SELECT 1=1')
+    register(pipeline, 'test_fails', [{'id': 2}], table='table_4', how=['id'], test='SELECT 1=2', query='SELECT 1')
+    register(pipeline, 'query_fails', [{'id': 3}], table='table_5', how=['id'], query='SELECT')
+    register(pipeline, 'empty', [], table='table_6', how=['id'])
+    register(pipeline, 'ok', [{'id': 4}], table='table_7', how=['id'], test='SELECT 1=1', query='SELECT 1')
+
+    reports = pipeline.run()
+    assert [report['message'] for report in reports] == [
+        'extract failed', 'extract failed', 'load failed', 'test failed', 'query failed', 'data is empty', 'success']
+    # a failed load skips the test, a failed test skips the query
+    assert 'test' not in reports[2] and 'query' not in reports[3]
+
+
+def test_pipeline_test_query_raise():
+    stub = StubClient()
+    pipeline = pygbq.Pipeline(stub, max_workers=2)
+    register(pipeline, 'test_raises', [{'id': 1}], table='table_1', how=['id'], test="SELECT {missing}")
+    register(pipeline, 'query_raises', [{'id': 2}], table='table_2', how=['id'], query="SELECT '{missing}'")
+    register(pipeline, 'ok', [{'id': 3}], table='table_3', how=['id'],
+             test='SELECT 1=1', query="DELETE FROM table_3 WHERE day = '{day}'")
+
+    reports = pipeline.run(day='2021-01-01')
+    assert [report['message'] for report in reports] == ['test failed', 'query failed', 'success']
+    assert 'test_seconds' in reports[0] and 'query_seconds' in reports[1]
+    assert ('query', "DELETE FROM table_3 WHERE day = '2021-01-01'") in stub.events
+
+
+def test_pipeline():
+    pipeline = pygbq.Pipeline(client, max_workers=2)
+
+    @pipeline.gbq(table='test_dataset.test_table', how=['id'], test='SELECT 1=1')
+    def test_table():
+        return [{'id': 5, 'string_column': 'test_pipeline_5'}, {'id': 6, 'string_column': 'test_pipeline_6'}]
+
+    @pipeline.gbq(table='test_dataset.test_table', how=['id'])
+    def test_table_empty():
+        return []
+
+    reports = pipeline.run()
+    assert [report['message'] for report in reports] == ['success', 'data is empty']
+    assert reports[0]['data_len'] == 2 and reports[0]['test'] is True
+    assert 'load_seconds' in reports[0] and 'extract_seconds' in reports[1]
 
 
 def test_test():